@@ -29,7 +29,9 @@ document.getElementById('generateBtn').addEventListener('click', async () => {
             statusMsg.style.color = "#4caf50";
             statusMsg.textContent = data.message;
         } else {
-            throw new Error(data.detail || "An error occurred");
+            // Validation errors (422) carry a list of details
+            const detail = Array.isArray(data.detail) ? data.detail[0].msg : data.detail;
+            throw new Error(detail || "An error occurred");
         }
     } catch (error) {
         statusMsg.style.color = "#f44336";
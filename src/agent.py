@@ -3,14 +3,30 @@ Agent module for generating Python docstrings using Google's Gemini models.
 Compatible with Python 3.12+.
 """
 
+import io
 import os
 import re
 import ast
+import json
+import asyncio
+import atexit
+import builtins
+import copy
+import hashlib
+import functools
+import importlib.util
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 from dotenv import load_dotenv
 from langchain_core.prompts import PromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
+
+try:
+    # google-re2 compiles to a DFA: linear-time matching, no backtracking
+    import re2 as regex_engine
+except ImportError:
+    regex_engine = re
 
 # ----------------------------------------------------------------------
 # 1. ENVIRONMENT – Find .env robustly
@@ -56,11 +72,79 @@ print(f"🔑 Using API key from: {KEY_SOURCE}")
 # ----------------------------------------------------------------------
 # 3. MODEL – gemini-flash-latest (available for all new keys)
 # ----------------------------------------------------------------------
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.5-flash",
-    google_api_key=API_KEY,
-    temperature=0.1,
-)
+# Tuned for latency: near-greedy sampling and no "thinking" tokens, which
+# Gemini 2.5 Flash would otherwise decode before answering.
+MODEL_NAME = "gemini-2.5-flash"
+TEMPERATURE = 0.1
+TOP_K = 1
+TOP_P = 0.1
+THINKING_BUDGET = 0
+
+# Output is the whole input code plus docstrings, and for compact code the
+# docstrings can outweigh the code itself. Code averages ~4 characters per
+# token, so len(code) tokens leaves ample room while still stopping runaway
+# generations. Budgets are rounded up to a power of two so only a handful
+# of bound chains ever exist. Output cut off at the cap is reported as an
+# error and never cached.
+MIN_OUTPUT_TOKENS = 1024
+MAX_OUTPUT_TOKENS = 65536
+TRUNCATED_FINISH_REASON = "MAX_TOKENS"
+
+# Connection pool shared by every Gemini call: idle connections are kept
+# open for minutes so bursts of requests skip the TCP + TLS handshake.
+# HTTP/2 multiplexes concurrent calls over one connection when the h2
+# package is installed (httpx[http2]).
+HTTP_MAX_KEEPALIVE = 32
+HTTP_KEEPALIVE_EXPIRY = 300
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _http_client_args() -> dict:
+    """httpx client arguments for the google-genai transports."""
+    import httpx
+
+    return {
+        "http2": HTTP2_AVAILABLE,
+        "limits": httpx.Limits(
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+
+@functools.cache
+def _get_llm():
+    """
+    Build the Gemini chat model on first use.
+
+    langchain_google_genai pulls in grpc, google-auth and many pydantic
+    models, so it is only imported once a request actually needs the model.
+    """
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    return ChatGoogleGenerativeAI(
+        model=MODEL_NAME,
+        google_api_key=API_KEY,
+        temperature=TEMPERATURE,
+        top_k=TOP_K,
+        top_p=TOP_P,
+        thinking_budget=THINKING_BUDGET,
+        client_args=_http_client_args(),
+    )
+
+
+def check_finish_reason(finish_reason: str | None) -> None:
+    """Raise if the model stopped because it hit max_output_tokens."""
+    if finish_reason == TRUNCATED_FINISH_REASON:
+        raise RuntimeError("The model output was truncated (max_output_tokens reached).")
+
+
+def output_token_budget(code: str) -> int:
+    """Return the max_output_tokens cap to use for a given source."""
+    budget = MIN_OUTPUT_TOKENS
+    while budget < len(code) and budget < MAX_OUTPUT_TOKENS:
+        budget *= 2
+    return budget
 
 # ----------------------------------------------------------------------
 # 4. PROMPT – One‑shot example with conditional syntax-error rule
@@ -98,7 +182,54 @@ def multiply(x, y):
 # ----------------------------------------------------------------------
 # 5. CHAIN
 # ----------------------------------------------------------------------
-chain = docstring_prompt | llm
+MAX_CONCURRENCY = 8
+
+
+@functools.cache
+def _get_chain(max_output_tokens: int):
+    """Chain with the output-token cap bound (one per budget bucket)."""
+    return docstring_prompt | _get_llm().bind(max_output_tokens=max_output_tokens)
+
+
+async def ainvoke_many(codes: list[str]) -> list:
+    """
+    Run the chain over many sources with bounded concurrency.
+
+    Sources are grouped by output-token budget and each group goes through
+    one `abatch` call. Failures, including truncated outputs, are returned
+    in place as exceptions.
+    """
+    groups: dict[int, list[int]] = {}
+    for i, code in enumerate(codes):
+        groups.setdefault(output_token_budget(code), []).append(i)
+
+    responses: list = [None] * len(codes)
+
+    async def run_group(budget: int, indices: list[int]) -> None:
+        try:
+            # Building the model lazily can fail (import, validation); report
+            # it per input like any other call error
+            chain = _get_chain(budget)
+        except Exception as e:
+            for i in indices:
+                responses[i] = e
+            return
+
+        group_responses = await chain.abatch(
+            [{"code": codes[i]} for i in indices],
+            config={"max_concurrency": MAX_CONCURRENCY},
+            return_exceptions=True,
+        )
+        for i, response in zip(indices, group_responses):
+            if not isinstance(response, Exception):
+                try:
+                    check_finish_reason(response.response_metadata.get("finish_reason"))
+                except RuntimeError as e:
+                    response = e
+            responses[i] = response
+
+    await asyncio.gather(*(run_group(budget, indices) for budget, indices in groups.items()))
+    return responses
 
 # ----------------------------------------------------------------------
 # 6. RESPONSE EXTRACTOR – Handles any format (string, list, dict)
@@ -131,131 +262,1248 @@ def extract_text_from_response(response) -> str:
     return str(content)
 
 # ----------------------------------------------------------------------
-# 7. SYNTAX CHECKER
+# 7. SYNTAX CHECKER & AST HELPERS
 # ----------------------------------------------------------------------
+_SCOPE_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+@functools.lru_cache(maxsize=128)
+def _parse(code: str) -> ast.Module | None:
+    """
+    Parse code once per request and share the tree between all checks.
+
+    Returns None for code with syntax errors, null bytes, or nesting too
+    deep for the parser. The tree is shared, so callers must treat it as
+    read-only.
+    """
+    try:
+        return ast.parse(code)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return None
+
+
 def is_valid_python(code: str) -> bool:
     """Check if the code is syntactically valid Python."""
-    try:
-        ast.parse(code)
-        return True
-    except SyntaxError:
+    return _parse(code) is not None
+
+
+def is_fully_documented(code: str) -> bool:
+    """Check if the module and every function/class already has a docstring."""
+    tree = _parse(code)
+    if tree is None:
         return False
+    return all(
+        ast.get_docstring(node, clean=False) is not None
+        for node in ast.walk(tree)
+        if isinstance(node, (ast.Module, *_SCOPE_NODES))
+    )
+
+
+def _iter_scopes(node: ast.AST, prefix: str = ""):
+    """Yield (qualname, node) for every function and class, depth first."""
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, _SCOPE_NODES):
+            qualname = f"{prefix}{child.name}"
+            yield qualname, child
+            yield from _iter_scopes(child, qualname + ".")
+        else:
+            yield from _iter_scopes(child, prefix)
+
+
+def _keyed_scopes(tree: ast.AST) -> list[tuple[tuple[str, int], ast.AST]]:
+    """Like _iter_scopes, keyed by (qualname, occurrence of that qualname)."""
+    seen: dict[str, int] = {}
+    keyed = []
+    for qualname, node in _iter_scopes(tree):
+        occurrence = seen.get(qualname, 0)
+        seen[qualname] = occurrence + 1
+        keyed.append(((qualname, occurrence), node))
+    return keyed
+
+
+def _docstring_expr(node: ast.AST) -> ast.Expr | None:
+    """Return the docstring statement of a module/function/class, if any."""
+    body = getattr(node, "body", None)
+    if (
+        body
+        and isinstance(body[0], ast.Expr)
+        and isinstance(body[0].value, ast.Constant)
+        and isinstance(body[0].value.value, str)
+    ):
+        return body[0]
+    return None
+
+
+def _first_line(node: ast.stmt) -> int:
+    """Line number where a statement starts, including its decorators."""
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno, *(d.lineno for d in decorators)])
+
+
+def _inline_body(lines: list[str], node: ast.AST) -> bool:
+    """True if the body of node starts on a line shared with other code."""
+    first = node.body[0]
+    return bool(lines[_first_line(first) - 1][: first.col_offset].strip())
+
+
+_LINE_RE = re.compile(r"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+$")
+
+
+def _split_lines(source: str) -> list[str]:
+    """
+    Split source into lines (keeping their endings) the way ast counts them.
+
+    str.splitlines also breaks on form feeds, \x1c-\x1e, \x85 and \u2028,
+    which may appear in strings and comments and would shift every later
+    line number.
+    """
+    return _LINE_RE.findall(source)
 
 # ----------------------------------------------------------------------
 # 8. DOCSTRING INDENTATION FIXER – Perfect Google style
 # ----------------------------------------------------------------------
-def fix_docstring_indentation(code: str) -> str:
-    """Ensures Args/Returns are indented 4 spaces, descriptions 8 spaces."""
-    lines = code.split('\n')
-    fixed_lines = []
-    i = 0
-    in_docstring = False
-    docstring_indent = 0
-
-    while i < len(lines):
-        line = lines[i]
-
-        if '"""' in line and not in_docstring:
-            in_docstring = True
-            docstring_indent = len(line) - len(line.lstrip())
-            fixed_lines.append(line)
-            i += 1
-            continue
+# Inline (?s)/(?m) flags and no backreferences keep these patterns valid
+# for both google-re2 and the standard re module.
+_SECTION_TAGS = ("Args:", "Returns:", "Yields:", "Raises:")
+_DOC_RE = regex_engine.compile(r'(?s)"""(?P<body>.*?)"""')
+# The leading \n keeps a summary line such as """Returns: x. from matching
+_SECTION_RE = regex_engine.compile(
+    r'\n[ \t]*(?P<tag>Args|Returns|Yields|Raises):(?P<rest>.*)\n'
+    r'(?P<entries>(?:[ \t]*\S.*(?:\n|$))*)'
+)
 
-        if in_docstring:
-            stripped = line.lstrip()
-            if stripped.startswith(('Args:', 'Returns:', 'Yields:', 'Raises:')):
-                proper_indent = ' ' * (docstring_indent + 4)
-                fixed_lines.append(proper_indent + stripped)
-            elif stripped and not stripped.startswith('"""'):
-                current_indent = len(line) - len(stripped)
-                if current_indent <= docstring_indent + 4:
-                    proper_indent = ' ' * (docstring_indent + 8)
-                    fixed_lines.append(proper_indent + stripped)
-                else:
-                    fixed_lines.append(line)
-            else:
-                fixed_lines.append(line)
 
-            if '"""' in line and line.strip().endswith('"""') and not line.strip().startswith('"""'):
-                in_docstring = False
-                docstring_indent = 0
-            i += 1
-            continue
+def _fix_section(match: re.Match, indent: str) -> str:
+    """Put a section header at the docstring indent and its entries 4 deeper."""
+    entry_indent = indent + "    "
+    fixed = [f"\n{indent}{match.group('tag')}:{match.group('rest')}\n"]
+    for line in match.group("entries").splitlines(keepends=True):
+        stripped = line.lstrip(" \t")
+        # A following section that is not separated by a blank line
+        if stripped.startswith(_SECTION_TAGS):
+            line = indent + stripped
+        # Deeper lines are continuations and keep their own indentation
+        elif len(line) - len(stripped) <= len(entry_indent):
+            line = entry_indent + stripped
+        fixed.append(line)
+    return "".join(fixed)
+
+
+def fix_docstring_indentation(code: str) -> str:
+    """Ensures Args/Returns are indented 4 spaces, descriptions 8 spaces."""
 
-        fixed_lines.append(line)
-        i += 1
+    def fix_docstring(match: re.Match) -> str:
+        line_start = code.rfind("\n", 0, match.start()) + 1
+        indent = code[line_start:match.start()]
+        # Only docstring-style literals (opening quotes start the line)
+        if indent.strip(" \t"):
+            return match.group(0)
+        body = _SECTION_RE.sub(lambda m: _fix_section(m, indent), match.group("body"))
+        return f'"""{body}"""'
 
-    return '\n'.join(fixed_lines)
+    return _DOC_RE.sub(fix_docstring, code)
 
 # ----------------------------------------------------------------------
 # 9. POST-PROCESSOR – Only remove TODO comments if code was valid
 # ----------------------------------------------------------------------
+SYNTAX_TODO = "# TODO: Fix syntax error"
+
+
+def _drop_syntax_todos(text: str) -> str:
+    """Remove every line that carries the syntax-error TODO comment."""
+    buf = io.StringIO()
+    for line in text.splitlines(keepends=True):
+        if SYNTAX_TODO not in line:
+            buf.write(line)
+    return buf.getvalue()
+
+
 def clean_output(output: str, original_code: str) -> str:
     """
     - If original code is valid: remove any hallucinated '# TODO: Fix syntax error'.
     - If original code is invalid: keep (or add) the TODO comment.
     - Restore missing function body if the model stripped it.
     """
-    lines = output.splitlines()
+    cleaned = output
 
     # Only remove TODO comments if the original code is valid
-    if is_valid_python(original_code):
-        lines = [line for line in lines if "# TODO: Fix syntax error" not in line]
-
-    cleaned = '\n'.join(lines).strip()
-
-    # Restore missing body (rare, but safeguard)
-    if cleaned.count('def ') == 1 and 'return' not in cleaned:
-        match = re.search(r'"""(.*?)"""', cleaned, re.DOTALL)
-        if match:
-            docstring = match.group(0)
-            sig_match = re.search(r'def \w+\([^)]*\):', cleaned)
-            if sig_match:
-                sig = sig_match.group(0)
-                body_match = re.search(r':\s*(.*)', original_code, re.DOTALL)
-                if body_match:
-                    body = body_match.group(1).strip()
-                    return f"{sig}\n    {docstring}\n    {body}"
-                else:
-                    return f"{sig}\n    {docstring}\n{original_code}"
-    return cleaned
+    if SYNTAX_TODO in output and is_valid_python(original_code):
+        cleaned = _drop_syntax_todos(output)
+
+    cleaned = cleaned.strip()
+
+    # Restore missing bodies (rare, but safeguard)
+    return _restore_bodies(cleaned, original_code)
+
+
+def _is_placeholder(statements: list[ast.stmt]) -> bool:
+    """True if every statement is `pass` or a bare `...`."""
+    return all(
+        isinstance(stmt, ast.Pass)
+        or (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant) and stmt.value.value is Ellipsis)
+        for stmt in statements
+    )
+
+
+def _restore_bodies(output: str, original_code: str) -> str:
+    """
+    Put back function bodies the model replaced with just a docstring.
+
+    Functions in the output whose body is only a docstring (optionally
+    followed by `pass`/`...`) get the body of the matching function from
+    the original code, and the output is re-emitted with `ast.unparse`.
+    Functions are matched by qualname and occurrence, so redefinitions such
+    as a property getter and its setter are told apart.
+    Output that needed no repair is returned untouched.
+    """
+    original = _parse(original_code)
+    tree = _parse(output)
+    if original is None or tree is None:
+        return output
+
+    originals = dict(_keyed_scopes(original))
+    repairs = {}
+    for key, node in _keyed_scopes(tree):
+        source = originals.get(key)
+        if (
+            not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+            or source is None
+            or _docstring_expr(node) is None
+            or not _is_placeholder(node.body[1:])
+        ):
+            continue
+        body = source.body[1:] if _docstring_expr(source) is not None else source.body
+        if not _is_placeholder(body):
+            repairs[key] = body
+
+    if not repairs:
+        return output
+
+    # The parsed trees are shared through _parse, so edit a copy (same shape,
+    # so the occurrence keys line up with the ones computed above)
+    tree = copy.deepcopy(tree)
+    for key, node in _keyed_scopes(tree):
+        if key in repairs:
+            node.body = [node.body[0], *copy.deepcopy(repairs[key])]
+    return ast.unparse(tree)
 
 # ----------------------------------------------------------------------
-# 10. MAIN FUNCTION
+# 10. RESPONSE CACHE – Content-addressed, keyed by SHA-256 of the source
 # ----------------------------------------------------------------------
-def generate_docstrings(source_code: str) -> str:
+# Optional shared cache for multi-process deployments. LLM_CACHE_DB points
+# LangChain's SQLite cache at a file; LLM_CACHE_MEMCACHED points it at a
+# memcached server ("host:port"). Both need langchain-community installed.
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB")
+LLM_CACHE_MEMCACHED = os.getenv("LLM_CACHE_MEMCACHED")
+
+if LLM_CACHE_DB or LLM_CACHE_MEMCACHED:
+    try:
+        from langchain_core.globals import set_llm_cache
+
+        if LLM_CACHE_MEMCACHED:
+            from langchain_community.cache import MemcachedCache
+            from pymemcache.client.base import Client as MemcachedClient
+
+            set_llm_cache(MemcachedCache(MemcachedClient(LLM_CACHE_MEMCACHED)))
+            print(f"🗄️  Shared LLM cache: memcached at {LLM_CACHE_MEMCACHED}")
+        else:
+            from langchain_community.cache import SQLiteCache
+
+            set_llm_cache(SQLiteCache(database_path=LLM_CACHE_DB))
+            print(f"🗄️  Shared LLM cache: SQLite at {LLM_CACHE_DB}")
+    except ImportError as e:
+        print(f"⚠️  Shared LLM cache disabled ({e}). Using in-memory cache only.")
+
+
+def normalize_source(source_code: str) -> str:
+    """Normalize source code before hashing (trailing whitespace is irrelevant)."""
+    return source_code.rstrip()
+
+
+def hash_source(source_code: str) -> str:
+    """Return the SHA-256 hex digest of already-normalized source code."""
+    return hashlib.sha256(source_code.encode("utf-8")).hexdigest()
+
+
+RESPONSE_CACHE_SIZE = 512
+_response_cache: OrderedDict[str, str] = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def cache_get(code_hash: str) -> str | None:
+    """Return the cached output for a source hash, marking it recently used."""
+    with _response_cache_lock:
+        output = _response_cache.get(code_hash)
+        if output is not None:
+            _response_cache.move_to_end(code_hash)
+        return output
+
+
+def cache_put(code_hash: str, output: str) -> None:
+    """Store a post-processed output, evicting the least recently used entry."""
+    with _response_cache_lock:
+        _response_cache[code_hash] = output
+        _response_cache.move_to_end(code_hash)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+def postprocess_output(raw_output: str, code: str, prompt_code: str | None = None) -> str:
+    """
+    Turn raw model text into the final documented code.
+
+    This is the string that gets cached, so cache hits skip the fence
+    stripping and regex passes as well as the Gemini round trip. When the
+    model was shown a minified prompt_code, its docstrings are spliced
+    into the original code instead.
+    """
+    raw_output = raw_output.strip()
+
+    # Remove accidental markdown fences
+    raw_output = raw_output.removeprefix("```python").removeprefix("```").removesuffix("```").strip()
+
+    if prompt_code is not None and prompt_code != code:
+        merged = _merge_docstrings(fix_docstring_indentation(raw_output), code)
+        if merged is not None:
+            return merged.strip()
+
+    # Post-process: clean hallucinated TODOs and restore body
+    raw_output = clean_output(raw_output, code)
+
+    # Fix indentation inside docstrings
+    return fix_docstring_indentation(raw_output).strip()
+
+# ----------------------------------------------------------------------
+# 11. SEMANTIC CACHE – Reuse docstrings for near-duplicate code
+# ----------------------------------------------------------------------
+# Near-duplicates (same code modulo comments/formatting, or very similar
+# code) are matched by embedding the AST-normalized source and searching a
+# FAISS inner-product index. A hit re-uses the cached docstrings by
+# splicing them into the *submitted* code, so the user's own code is
+# always what comes back. A docstring is only reused when the function's
+# parameters and return annotation are unchanged, and code longer than the
+# encoder's window is never matched. Requires faiss-cpu plus an encoder
+# backend; silently disabled when they are not installed.
+#
+# The encoder is the per-miss bottleneck, so with optimum[onnxruntime]
+# installed the model is exported to ONNX and dynamically quantized to int8
+# (AVX-512 VNNI) once, then cached on disk. sentence-transformers (fp32) is
+# the fallback backend.
+SEMANTIC_CACHE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_CACHE_MAX_TOKENS = 256
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+# New entries are written to disk in batches (and at exit), not per request
+SEMANTIC_CACHE_PERSIST_EVERY = 32
+SEMANTIC_CACHE_DIR = Path(
+    os.getenv("SEMANTIC_CACHE_DIR", Path(__file__).parent.parent / ".semantic_cache")
+)
+
+
+def _has_modules(*modules: str) -> bool:
+    """Check that optional modules are installed without importing them."""
+    return all(importlib.util.find_spec(module) is not None for module in modules)
+
+
+QUANTIZED_ENCODER_AVAILABLE = _has_modules("optimum", "onnxruntime", "transformers")
+SEMANTIC_CACHE_ENABLED = _has_modules("faiss") and (
+    QUANTIZED_ENCODER_AVAILABLE or _has_modules("sentence_transformers")
+)
+
+_semantic_lock = threading.Lock()
+_semantic_init_lock = threading.Lock()
+_semantic_state = None
+_semantic_persist_lock = threading.Lock()
+_semantic_unsaved = 0
+
+
+def _canonical(code: str) -> str:
+    """Strip comments and formatting by round-tripping through the AST."""
+    tree = _parse(code)
+    return ast.unparse(tree) if tree is not None else code.strip()
+
+
+def _signature(node: ast.AST) -> str:
+    """Dump a function's parameters and return annotation ('' otherwise)."""
+    if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return ""
+    returns = ast.dump(node.returns) if node.returns is not None else ""
+    return ast.dump(node.args) + returns
+
+
+def _collect_docstrings(
+    tree: ast.Module, source: str
+) -> dict[tuple[str, int], tuple[str, int, str]]:
+    """
+    Map (qualname, occurrence) to (raw literal, column, signature).
+
+    The module is keyed ("", 0). Keys match _keyed_scopes, so redefinitions
+    such as a property getter and its setter keep their own docstrings.
+    """
+    docstrings = {}
+    for key, node in [(("", 0), tree), *_keyed_scopes(tree)]:
+        expr = _docstring_expr(node)
+        if expr is not None:
+            literal = ast.get_source_segment(source, expr)
+            if literal is not None:
+                docstrings[key] = (literal, expr.col_offset, _signature(node))
+    return docstrings
+
+
+def _reindent(literal: str, old_col: int, indent: str) -> str:
+    """Move a multi-line docstring literal from column old_col to indent."""
+    head, *rest = literal.split("\n")
+    lines = [indent + head]
+    for line in rest:
+        if line.strip():
+            strip = min(old_col, len(line) - len(line.lstrip()))
+            lines.append(indent + line[strip:])
+        else:
+            lines.append("")
+    return "\n".join(lines)
+
+
+def _splice_docstrings(
+    source: str,
+    tree: ast.Module,
+    docstrings: dict[tuple[str, int], tuple[str, int, str]],
+    partial: bool = False,
+) -> str | None:
+    """
+    Insert docstrings into every undocumented function/class of source.
+
+    Existing docstrings are kept. Returns None when a function or class
+    has no matching docstring, its parameters or return annotation differ
+    from the ones the docstring was written for, or its body shares a line
+    with the header, so callers can fall back to another path. With
+    partial=True, functions/classes without a matching docstring are
+    skipped instead, but a docstring that cannot be placed still gives None.
+    """
+    lines = _split_lines(source)
+    inserts = []
+    for key, node in [(("", 0), tree), *_keyed_scopes(tree)]:
+        if not node.body or _docstring_expr(node) is not None:
+            continue
+        if key not in docstrings:
+            if node is tree or partial:
+                continue
+            return None
+        if docstrings[key][2] != _signature(node) or _inline_body(lines, node):
+            return None
+        first = node.body[0]
+        first_line = _first_line(first)
+        indent = lines[first_line - 1][: first.col_offset]
+        # Go above comments that open the body, right under the header
+        if node is not tree:
+            while first_line - 1 > node.lineno and (
+                not lines[first_line - 2].strip()
+                or lines[first_line - 2].lstrip().startswith("#")
+            ):
+                first_line -= 1
+        literal, old_col, _ = docstrings[key]
+        inserts.append((first_line, _reindent(literal, old_col, indent) + "\n"))
+
+    for first_line, text in sorted(inserts, reverse=True):
+        lines.insert(first_line - 1, text)
+    return "".join(lines)
+
+
+def _load_quantized_encoder():
+    """Return (encode, tokenizer, dimension) for the int8 ONNX model."""
+    import numpy as np
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model_dir = SEMANTIC_CACHE_DIR / "minilm-int8"
+    if not (model_dir / "model_quantized.onnx").exists():
+        exported = ORTModelForFeatureExtraction.from_pretrained(SEMANTIC_CACHE_MODEL, export=True)
+        ORTQuantizer.from_pretrained(exported).quantize(
+            save_dir=model_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False),
+        )
+        AutoTokenizer.from_pretrained(SEMANTIC_CACHE_MODEL).save_pretrained(model_dir)
+
+    model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name="model_quantized.onnx")
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    def encode(text: str):
+        inputs = tokenizer(
+            [text], truncation=True, max_length=SEMANTIC_CACHE_MAX_TOKENS, return_tensors="np"
+        )
+        hidden = model(**inputs).last_hidden_state
+        # Mean pooling + L2 normalization, as sentence-transformers does
+        mask = inputs["attention_mask"][..., None]
+        vector = (hidden * mask).sum(axis=1) / mask.sum(axis=1)
+        return (vector / np.linalg.norm(vector, axis=1, keepdims=True)).astype("float32")
+
+    return encode, tokenizer, model.config.hidden_size
+
+
+def _load_sentence_transformer():
+    """Return (encode, tokenizer, dimension) for the fp32 model."""
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(SEMANTIC_CACHE_MODEL, device="cpu")
+    model.max_seq_length = SEMANTIC_CACHE_MAX_TOKENS
+
+    def encode(text: str):
+        return model.encode([text], normalize_embeddings=True)
+
+    return encode, model.tokenizer, model.get_sentence_embedding_dimension()
+
+
+def _semantic_store():
+    """
+    Load the encoder and the persisted FAISS index (once).
+
+    Concurrent first requests wait for a single load/ONNX export. If it
+    fails the semantic cache is disabled for the rest of the process
+    rather than retried on every request.
+    """
+    global _semantic_state, SEMANTIC_CACHE_ENABLED
+    if _semantic_state is not None:
+        return _semantic_state
+    with _semantic_init_lock:
+        if _semantic_state is None:
+            if not SEMANTIC_CACHE_ENABLED:
+                raise RuntimeError("semantic cache is disabled")
+            try:
+                _semantic_state = _load_semantic_store()
+            except Exception as e:
+                SEMANTIC_CACHE_ENABLED = False
+                print(f"⚠️  Semantic cache disabled: {e}")
+                raise
+    return _semantic_state
+
+
+def _load_semantic_store():
+    """Return (encode, tokenizer, index, outputs) read from SEMANTIC_CACHE_DIR."""
+    import faiss
+
+    if QUANTIZED_ENCODER_AVAILABLE:
+        encode, tokenizer, dimension = _load_quantized_encoder()
+    else:
+        encode, tokenizer, dimension = _load_sentence_transformer()
+
+    index_path = SEMANTIC_CACHE_DIR / "index.faiss"
+    outputs_path = SEMANTIC_CACHE_DIR / "outputs.json"
+    if index_path.exists() and outputs_path.exists():
+        index = faiss.read_index(str(index_path))
+        outputs = json.loads(outputs_path.read_text(encoding="utf-8"))
+        # The two files are replaced one after the other; a crash in
+        # between leaves them out of step
+        if index.ntotal != len(outputs):
+            index, outputs = faiss.IndexFlatIP(dimension), []
+    else:
+        index = faiss.IndexFlatIP(dimension)
+        outputs = []
+    return encode, tokenizer, index, outputs
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    """Write data to a sibling temp file, then rename it over path."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def _persist_semantic_cache() -> None:
+    """Write the index and outputs to disk if there are unsaved entries."""
+    global _semantic_unsaved
+    import faiss
+
+    with _semantic_persist_lock:
+        _, _, index, outputs = _semantic_store()
+        with _semantic_lock:
+            if _semantic_unsaved == 0:
+                return
+            index_bytes = faiss.serialize_index(index).tobytes()
+            outputs_json = json.dumps(outputs).encode("utf-8")
+            _semantic_unsaved = 0
+        SEMANTIC_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _write_atomic(SEMANTIC_CACHE_DIR / "outputs.json", outputs_json)
+        _write_atomic(SEMANTIC_CACHE_DIR / "index.faiss", index_bytes)
+
+
+@atexit.register
+def _flush_semantic_cache() -> None:
+    """Persist entries added since the last batch write."""
+    if _semantic_unsaved:
+        try:
+            _persist_semantic_cache()
+        except Exception as e:
+            print(f"⚠️  Semantic cache persist failed: {e}")
+
+
+def _embed(code: str):
+    """
+    Embed the canonical form of code as a normalized float32 row vector.
+
+    Returns None when the code is longer than the encoder's window: the
+    truncated tail would be invisible to the similarity search.
+    """
+    encode, tokenizer, _, _ = _semantic_store()
+    text = _canonical(code)
+    if len(tokenizer(text)["input_ids"]) > SEMANTIC_CACHE_MAX_TOKENS:
+        return None
+    return encode(text)
+
+
+def semantic_lookup(code: str) -> str | None:
+    """Return code with docstrings from the closest cached entry, or None."""
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    tree = _parse(code)
+    if tree is None:
+        return None
+    try:
+        vector = _embed(code)
+        if vector is None:
+            return None
+        _, _, index, outputs = _semantic_store()
+        with _semantic_lock:
+            if index.ntotal == 0:
+                return None
+            scores, ids = index.search(vector, 1)
+            if scores[0][0] < SEMANTIC_CACHE_THRESHOLD:
+                return None
+            cached_output = outputs[ids[0][0]]
+    except Exception as e:
+        print(f"⚠️  Semantic cache lookup failed: {e}")
+        return None
+    cached_tree = _parse(cached_output)
+    if cached_tree is None:
+        return None
+    return _splice_docstrings(code, tree, _collect_docstrings(cached_tree, cached_output))
+
+
+def semantic_store(code: str, output: str) -> None:
+    """
+    Add a generated output to the index, evicting the oldest entry once
+    SEMANTIC_CACHE_MAX_ENTRIES is reached. Written to disk in batches.
+    """
+    global _semantic_unsaved
+    if not SEMANTIC_CACHE_ENABLED or output.startswith("# Error"):
+        return
+    try:
+        import numpy as np
+
+        vector = _embed(code)
+        if vector is None:
+            return
+        _, _, index, outputs = _semantic_store()
+        with _semantic_lock:
+            excess = index.ntotal - SEMANTIC_CACHE_MAX_ENTRIES + 1
+            if excess > 0:
+                index.remove_ids(np.arange(excess, dtype="int64"))
+                del outputs[:excess]
+            index.add(vector)
+            outputs.append(output)
+            _semantic_unsaved += 1
+            persist = _semantic_unsaved >= SEMANTIC_CACHE_PERSIST_EVERY
+        if persist:
+            _persist_semantic_cache()
+    except Exception as e:
+        print(f"⚠️  Semantic cache store failed: {e}")
+
+# ----------------------------------------------------------------------
+# 12. PROMPT MINIFICATION – Send fewer input tokens, keep the user's code
+# ----------------------------------------------------------------------
+# For valid code the model only has to author docstrings, so the prompt
+# gets an `ast.unparse` rendering: comments and blank lines are dropped,
+# and scopes that are already fully documented are reduced to their
+# docstring and `...`. Code that may use undefined names is sent as-is so
+# the model's rule-5 TODO comments are kept. Undocumented functions keep their logic so
+# Returns/Raises stay accurate. The generated docstrings are then spliced
+# into the original, untouched source, so nothing the model does to the
+# code itself can leak into the result.
+_MODULE_NAMES = frozenset(dir(builtins)) | {
+    "__name__", "__file__", "__doc__", "__spec__", "__loader__",
+    "__package__", "__builtins__", "__path__", "__annotations__",
+}
+
+
+def _may_reference_undefined_names(tree: ast.Module) -> bool:
+    """
+    Check whether prompt rule 5 (undefined-variable TODOs) could apply.
+
+    Scope-insensitive: a name counts as defined if it is bound anywhere in
+    the file. Star imports make the answer unknowable, so they count too.
+    """
+    defined = set(_MODULE_NAMES)
+    loaded = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (loaded if isinstance(node.ctx, ast.Load) else defined).add(node.id)
+        elif isinstance(node, ast.arg):
+            defined.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    return True
+                defined.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, (*_SCOPE_NODES, ast.Global, ast.Nonlocal)):
+            defined.update(getattr(node, "names", None) or [node.name])
+        elif isinstance(node, (ast.ExceptHandler, ast.MatchAs, ast.MatchStar)) and node.name:
+            defined.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            defined.add(node.rest)
+    return not loaded <= defined
+
+
+def _minify_for_prompt(code: str) -> str:
+    """Return the code to send to Gemini (the original if it can't shrink)."""
+    tree = _parse(code)
+    # The model's undefined-variable TODO comments would not survive the
+    # docstring-only merge, so such code is sent as-is. So is code with
+    # undocumented one-line bodies, which have nowhere to put a docstring.
+    if tree is None or _may_reference_undefined_names(tree):
+        return code
+    lines = _split_lines(code)
+    if any(
+        _docstring_expr(node) is None and _inline_body(lines, node)
+        for _, node in _iter_scopes(tree)
+    ):
+        return code
+
+    tree = copy.deepcopy(tree)
+    for _, node in _iter_scopes(tree):
+        if _docstring_expr(node) is not None and all(
+            _docstring_expr(child) is not None for _, child in _iter_scopes(node)
+        ):
+            node.body = [node.body[0], ast.Expr(ast.Constant(Ellipsis))]
+
+    minified = ast.unparse(tree)
+    return minified if len(minified) < len(code) else code
+
+
+def _merge_docstrings(output: str, code: str) -> str | None:
+    """
+    Splice docstrings from model output into code.
+
+    Returns None if either side is unparsable or a docstring the model
+    wrote cannot be placed, so the caller post-processes the output as is.
+    """
+    output_tree = _parse(output)
+    tree = _parse(code)
+    if output_tree is None or tree is None:
+        return None
+    return _splice_docstrings(
+        code, tree, _collect_docstrings(output_tree, output), partial=True
+    )
+
+# ----------------------------------------------------------------------
+# 13. BATCH MODE – Cheaper, delayed generation for non-interactive jobs
+# ----------------------------------------------------------------------
+# Requests with priority="batch" are queued and submitted together as one
+# inline Gemini Batch Mode job (about half the price of real-time calls).
+# A job is flushed after BATCH_MODE_FLUSH_SECONDS or once
+# BATCH_MODE_MAX_JOBS requests are waiting; each caller awaits its own
+# future until the job finishes.
+BATCH_MODE_MAX_JOBS = 100
+BATCH_MODE_FLUSH_SECONDS = float(os.getenv("BATCH_MODE_FLUSH_SECONDS", "30"))
+BATCH_MODE_POLL_SECONDS = float(os.getenv("BATCH_MODE_POLL_SECONDS", "30"))
+_BATCH_MODE_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+_batch_queue: asyncio.Queue | None = None
+_batch_worker: asyncio.Task | None = None
+_batch_jobs: set[asyncio.Task] = set()
+
+
+@functools.cache
+def _genai_client():
+    """google-genai client used for Batch Mode (created on first use)."""
+    from google import genai
+
+    client_args = _http_client_args()
+    return genai.Client(
+        api_key=API_KEY,
+        http_options={"client_args": client_args, "async_client_args": client_args},
+    )
+
+
+async def _run_batch_job(jobs: list[tuple[str, asyncio.Future]]) -> None:
+    """Submit one inline batch job, poll it, and resolve the callers' futures."""
+    try:
+        client = _genai_client()
+        job = await client.aio.batches.create(
+            model=MODEL_NAME,
+            src=[
+                {
+                    "contents": [
+                        {"role": "user", "parts": [{"text": docstring_prompt.format(code=code)}]}
+                    ],
+                    "config": {
+                        "temperature": TEMPERATURE,
+                        "top_k": TOP_K,
+                        "top_p": TOP_P,
+                        "max_output_tokens": output_token_budget(code),
+                        "thinking_config": {"thinking_budget": THINKING_BUDGET},
+                    },
+                }
+                for code, _ in jobs
+            ],
+        )
+        while job.state.name not in _BATCH_MODE_DONE_STATES:
+            await asyncio.sleep(BATCH_MODE_POLL_SECONDS)
+            job = await client.aio.batches.get(name=job.name)
+
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch job {job.name} ended in state {job.state.name}")
+
+        responses = job.dest.inlined_responses or []
+        for (_, future), inlined in zip(jobs, responses):
+            if future.done():
+                continue
+            if inlined.error:
+                future.set_exception(RuntimeError(str(inlined.error)))
+                continue
+            candidates = inlined.response.candidates or []
+            finish_reason = candidates[0].finish_reason if candidates else None
+            try:
+                check_finish_reason(getattr(finish_reason, "name", finish_reason))
+            except RuntimeError as e:
+                future.set_exception(e)
+            else:
+                future.set_result(inlined.response.text or "")
+        # Never leave a caller waiting on a response that did not come back
+        if len(responses) < len(jobs):
+            raise RuntimeError(
+                f"Batch job {job.name} returned {len(responses)} of {len(jobs)} responses"
+            )
+    except Exception as e:
+        for _, future in jobs:
+            if not future.done():
+                future.set_exception(e)
+
+
+async def _batch_mode_worker(queue: asyncio.Queue) -> None:
+    """Collect queued requests into jobs and hand each job off."""
+    loop = asyncio.get_running_loop()
+    while True:
+        jobs = [await queue.get()]
+        deadline = loop.time() + BATCH_MODE_FLUSH_SECONDS
+        while len(jobs) < BATCH_MODE_MAX_JOBS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        task = asyncio.create_task(_run_batch_job(jobs))
+        _batch_jobs.add(task)
+        task.add_done_callback(_batch_jobs.discard)
+
+
+async def submit_batch_mode(code: str) -> str:
+    """Queue code for Gemini Batch Mode and wait for the raw model text."""
+    global _batch_queue, _batch_worker
+    if _batch_queue is None:
+        _batch_queue = asyncio.Queue()
+    if _batch_worker is None or _batch_worker.done():
+        _batch_worker = asyncio.create_task(_batch_mode_worker(_batch_queue))
+
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((code, future))
+    return await future
+
+# ----------------------------------------------------------------------
+# 14. MAIN FUNCTIONS
+# ----------------------------------------------------------------------
+EMPTY_SOURCE_ERROR = "# Error: The provided source code is empty."
+
+
+async def _lookup(code_hash: str, code: str) -> str | None:
+    """
+    Answer a source without Gemini when possible.
+
+    Checks the exact cache, then (in a worker thread, since both parse the
+    code) whether it is already fully documented and the semantic cache.
+    """
+    output = cache_get(code_hash)
+    if output is None:
+        output, semantic_hit = await asyncio.to_thread(_lookup_parsed, code)
+        if semantic_hit:
+            cache_put(code_hash, output)
+    return output
+
+
+def _lookup_parsed(code: str) -> tuple[str | None, bool]:
+    """Return (output, whether it came from the semantic cache) for _lookup."""
+    if is_fully_documented(code):
+        return code, False
+    if SEMANTIC_CACHE_ENABLED:
+        output = semantic_lookup(code)
+        return output, output is not None
+    return None, False
+
+
+def _remember(code_hash: str, code: str, output: str) -> str:
+    """Record a final output in both caches (blocking)."""
+    cache_put(code_hash, output)
+    semantic_store(code, output)
+    return output
+
+
+def _finish(code_hash: str, code: str, raw_output: str, prompt_code: str | None = None) -> str:
+    """Post-process model text and record it in both caches (blocking)."""
+    return _remember(code_hash, code, postprocess_output(raw_output, code, prompt_code))
+
+
+# Files above this size are split at top-level function/class boundaries
+# and each piece is documented separately, concurrently.
+CHUNK_THRESHOLD = 4000
+
+
+def _chunk_context(tree: ast.Module, node: ast.stmt) -> str:
+    """
+    Module-level code that binds the names a top-level definition uses.
+
+    Imports are kept as written; every other binding (constants, sibling
+    functions/classes, ...) is reduced to `name = ...` so the model sees
+    the name is defined without paying for its value.
+    """
+    loaded = {
+        child.id for child in ast.walk(node)
+        if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load)
+    }
+    context = []
+    for stmt in tree.body:
+        if stmt is node:
+            continue
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            if any(
+                alias.name == "*" or (alias.asname or alias.name.split(".")[0]) in loaded
+                for alias in stmt.names
+            ):
+                context.append(ast.unparse(stmt))
+            continue
+        bound = set()
+        if isinstance(stmt, _SCOPE_NODES):
+            bound.add(stmt.name)
+        else:
+            for child in ast.walk(stmt):
+                if isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load):
+                    bound.add(child.id)
+                elif isinstance(child, (ast.Import, ast.ImportFrom)):
+                    bound.update(alias.asname or alias.name.split(".")[0] for alias in child.names)
+                elif isinstance(child, _SCOPE_NODES):
+                    bound.add(child.name)
+        context.extend(f"{name} = ..." for name in sorted(bound & loaded))
+    return "\n".join(dict.fromkeys(context))
+
+
+def _split_top_level(tree: ast.Module, source: str) -> list[tuple[int, int, str]]:
+    """
+    Return (start, end, prompt) for every top-level function/class.
+
+    Ranges are 0-based and end-exclusive and include decorators. Code
+    between them (imports, constants, ...) is not part of any chunk, but
+    the prompt is prefixed with the _chunk_context the definition needs.
+    """
+    lines = _split_lines(source)
+    chunks = []
+    for node in tree.body:
+        if isinstance(node, _SCOPE_NODES):
+            start, end = _first_line(node) - 1, node.end_lineno
+            text = "".join(lines[start:end])
+            context = _chunk_context(tree, node)
+            chunks.append((start, end, f"{context}\n\n\n{text}" if context else text))
+    return chunks
+
+
+def _split_source(code: str) -> list[tuple[int, int, str]]:
+    """_split_top_level for source that may not parse (no chunks then)."""
+    tree = _parse(code)
+    return _split_top_level(tree, code) if tree is not None else []
+
+
+def _chunk_definition(output: str) -> str | None:
+    """Cut the one documented definition out of a chunk's output."""
+    tree = _parse(output)
+    if tree is None:
+        return None
+    scopes = [node for node in tree.body if isinstance(node, _SCOPE_NODES)]
+    if len(scopes) != 1:
+        return None
+    lines = _split_lines(output)
+    return "".join(lines[_first_line(scopes[0]) - 1 : scopes[0].end_lineno]).rstrip()
+
+
+CHUNK_MISMATCH_ERROR = "# Error generating docstrings: The model output did not match the input."
+
+
+PARTIAL_FAILURE_WARNING = "# Warning: Docstrings could not be generated for the definitions at line(s):"
+
+
+async def _agenerate_chunked(
+    code: str, chunks: list[tuple[int, int, str]], priority: str
+) -> tuple[str, bool]:
+    """
+    Document each chunk independently and stitch them back into code.
+
+    A chunk that fails (or whose output is not a single definition) keeps
+    its original text instead of failing the whole file, and the result is
+    prefixed with PARTIAL_FAILURE_WARNING naming the affected lines. If
+    every chunk fails, the first error message is returned instead.
+    Returns the output and whether every chunk succeeded.
+    """
+    outputs = await agenerate_docstrings_batch(
+        [text for _, _, text in chunks], [priority] * len(chunks)
+    )
+    # Parsing every chunk's output is CPU bound, so keep it off the event loop
+    return await asyncio.to_thread(_stitch_chunks, code, chunks, outputs)
+
+
+def _stitch_chunks(
+    code: str, chunks: list[tuple[int, int, str]], outputs: list[str]
+) -> tuple[str, bool]:
+    """Put each chunk's documented definition back in place (see above)."""
+    definitions = [
+        None if output.startswith("# Error") else _chunk_definition(output)
+        for output in outputs
+    ]
+    failed = [
+        start for (start, _, _), definition in zip(chunks, definitions)
+        if definition is None
+    ]
+    if len(failed) == len(chunks):
+        errors = [output for output in outputs if output.startswith("# Error")]
+        return (errors[0] if errors else CHUNK_MISMATCH_ERROR), False
+
+    lines = _split_lines(code)
+    parts = []
+    position = 0
+    for (start, end, _), definition in zip(chunks, definitions):
+        parts.append("".join(lines[position:start]))
+        parts.append("".join(lines[start:end]) if definition is None else definition + "\n")
+        position = end
+    parts.append("".join(lines[position:]))
+    stitched = "".join(parts).rstrip()
+
+    if failed:
+        failed_lines = ", ".join(str(start + 1) for start in failed)
+        return f"{PARTIAL_FAILURE_WARNING} {failed_lines}\n{stitched}", False
+    return stitched, True
+
+
+async def agenerate_docstrings_batch(
+    source_codes: list[str], priorities: list[str] | None = None
+) -> list[str]:
+    """
+    Add Google-style docstrings to many Python sources concurrently.
+
+    Cached inputs are answered immediately; the remaining unique
+    interactive sources go to Gemini through `chain.abatch` with bounded
+    concurrency, while batch-priority sources are queued for
+    Gemini Batch Mode.
+
+    Args:
+        source_codes: Raw Python source code strings.
+        priorities: Optional "interactive"/"batch" priority per source.
+            Defaults to "interactive" for every source.
+
+    Returns:
+        One documented source (or error message) per input, in order.
+    """
+    if priorities is None:
+        priorities = ["interactive"] * len(source_codes)
+
+    results: list[str | None] = [None] * len(source_codes)
+    pending: dict[str, list[int]] = {}
+    codes: dict[str, str] = {}
+    batch_mode: set[str] = set()
+    chunked: dict[str, list[tuple[int, int, str]]] = {}
+
+    for i, (source_code, priority) in enumerate(zip(source_codes, priorities)):
+        if not source_code or not source_code.strip():
+            results[i] = EMPTY_SOURCE_ERROR
+            continue
+
+        code = normalize_source(source_code)
+        code_hash = hash_source(code)
+        output = await _lookup(code_hash, code)
+        if output is not None:
+            results[i] = output
+            continue
+
+        # Identical sources within one batch share a single model call,
+        # which only waits for Batch Mode if no caller needs it interactively
+        if code_hash not in pending and priority == "batch":
+            batch_mode.add(code_hash)
+        elif priority != "batch":
+            batch_mode.discard(code_hash)
+        pending.setdefault(code_hash, []).append(i)
+        codes[code_hash] = code
+
+        # Large files are split so latency tracks the largest piece
+        if len(code) > CHUNK_THRESHOLD and code_hash not in chunked:
+            chunks = await asyncio.to_thread(_split_source, code)
+            if len(chunks) > 1:
+                chunked[code_hash] = chunks
+
+    if pending:
+        single = [code_hash for code_hash in pending if code_hash not in chunked]
+        interactive = [code_hash for code_hash in single if code_hash not in batch_mode]
+        deferred = [code_hash for code_hash in single if code_hash in batch_mode]
+        # parse + deepcopy + unparse is CPU bound, so keep it off the event loop
+        minified = await asyncio.to_thread(
+            lambda: [_minify_for_prompt(codes[code_hash]) for code_hash in single]
+        )
+        prompts = dict(zip(single, minified))
+        interactive_responses, deferred_responses, chunked_outputs = await asyncio.gather(
+            ainvoke_many([prompts[code_hash] for code_hash in interactive]),
+            asyncio.gather(
+                *(submit_batch_mode(prompts[code_hash]) for code_hash in deferred),
+                return_exceptions=True,
+            ),
+            asyncio.gather(
+                *(
+                    _agenerate_chunked(
+                        codes[code_hash],
+                        chunks,
+                        "batch" if code_hash in batch_mode else "interactive",
+                    )
+                    for code_hash, chunks in chunked.items()
+                )
+            ),
+        )
+        for code_hash, response in zip(
+            interactive + deferred, [*interactive_responses, *deferred_responses]
+        ):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                # Regex/AST post-processing and cache persistence are CPU and
+                # disk bound, so keep them off the event loop
+                output = await asyncio.to_thread(
+                    _finish,
+                    code_hash,
+                    codes[code_hash],
+                    extract_text_from_response(response),
+                    prompts[code_hash],
+                )
+            except Exception as e:
+                output = f"# Error generating docstrings: {str(e)}"
+            for i in pending[code_hash]:
+                results[i] = output
+
+        for code_hash, (output, complete) in zip(chunked, chunked_outputs):
+            if complete:
+                await asyncio.to_thread(_remember, code_hash, codes[code_hash], output)
+            for i in pending[code_hash]:
+                results[i] = output
+
+    return results
+
+
+async def agenerate_docstrings(source_code: str, priority: str = "interactive") -> str:
     """
     Add Google-style docstrings to Python source code using Gemini.
 
     Args:
         source_code: Raw Python source code as a string.
+        priority: "interactive" for a real-time call, "batch" to wait for
+            the cheaper Gemini Batch Mode.
 
     Returns:
         The same source code with docstrings inserted, or an error message.
     """
+    return (await agenerate_docstrings_batch([source_code], [priority]))[0]
+
+
+async def stream_docstrings(source_code: str):
+    """
+    Yield documented code as Gemini generates it.
+
+    Chunks are streamed raw (minus markdown fences) so the first characters
+    reach the client immediately. For valid source, output is released a
+    whole line at a time so hallucinated syntax-error TODO lines can be
+    dropped on the way. The accumulated text is post-processed
+    once at the end and cached, so later requests for the same source get
+    the fully cleaned-up result.
+
+    Args:
+        source_code: Raw Python source code as a string.
+
+    Yields:
+        Text chunks of the documented source, or an error message.
+    """
     if not source_code or not source_code.strip():
-        return "# Error: The provided source code is empty."
+        yield EMPTY_SOURCE_ERROR
+        return
 
+    code = normalize_source(source_code)
+    code_hash = hash_source(code)
+    output = await _lookup(code_hash, code)
+    if output is not None:
+        yield output
+        return
+
+    # _lookup already parsed the code in a worker thread; this hits _parse's cache
+    drop_todos = is_valid_python(code)
+    chunks = []
+    held = ""
+    started = False
+    emitted = False
+    finish_reason = None
     try:
-        response = chain.invoke({"code": source_code})
-        raw_output = extract_text_from_response(response).strip()
+        async for chunk in _get_chain(output_token_budget(code)).astream({"code": code}):
+            finish_reason = chunk.response_metadata.get("finish_reason") or finish_reason
+            text = extract_text_from_response(chunk)
+            chunks.append(text)
+            held += text
 
-        # Remove accidental markdown fences
-        if raw_output.startswith("```python"):
-            raw_output = raw_output[9:]
-        if raw_output.startswith("```"):
-            raw_output = raw_output[3:]
-        if raw_output.endswith("```"):
-            raw_output = raw_output[:-3]
+            # Wait until an opening fence would be complete before emitting
+            if not started:
+                if len(held.lstrip()) < len("```python"):
+                    continue
+                held = held.lstrip().removeprefix("```python").removeprefix("```").lstrip("\r\n")
+                started = True
+            # The newline after the fence may arrive in a later chunk
+            if not emitted:
+                held = held.lstrip("\r\n")
 
-        # Post-process: clean hallucinated TODOs and restore body
-        raw_output = clean_output(raw_output, source_code)
+            # Hold back what could turn out to be a closing fence
+            cut = len(held.rstrip()) - len("```")
+            if drop_todos:
+                cut = held.rfind("\n", 0, max(cut, 0)) + 1
+            if cut > 0:
+                text = _drop_syntax_todos(held[:cut]) if drop_todos else held[:cut]
+                if not emitted:
+                    text = text.lstrip("\r\n")
+                if text:
+                    yield text
+                    emitted = True
+                held = held[cut:]
 
-        # Fix indentation inside docstrings
-        raw_output = fix_docstring_indentation(raw_output)
+        # A truncated result is reported and never cached
+        check_finish_reason(finish_reason)
+    except Exception as e:
+        yield f"\n# Error generating docstrings: {str(e)}"
+        return
 
-        return raw_output.strip()
+    if not started:
+        held = held.lstrip().removeprefix("```python").removeprefix("```").lstrip("\r\n")
+    tail = held.rstrip().removesuffix("```")
+    if drop_todos:
+        tail = _drop_syntax_todos(tail)
+    if not emitted:
+        tail = tail.lstrip("\r\n")
+    if tail:
+        yield tail
 
-    except Exception as e:
-        return f"# Error generating docstrings: {str(e)}"
+    await asyncio.to_thread(_finish, code_hash, code, "".join(chunks))
+
+
+def generate_docstrings(source_code: str) -> str:
+    """Synchronous wrapper around `agenerate_docstrings` for scripts."""
+    return asyncio.run(agenerate_docstrings(source_code))
@@ -1,8 +1,21 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from src.models import CodeRequest, CodeResponse
-from src.agent import generate_docstrings
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from src.models import (
+    MAX_BATCH_ITEMS,
+    CodeRequest,
+    CodeResponse,
+    CodeBatchRequest,
+    CodeBatchResponse,
+)
+from src.agent import (
+    PARTIAL_FAILURE_WARNING,
+    agenerate_docstrings,
+    agenerate_docstrings_batch,
+    stream_docstrings,
+)
+from pathlib import Path
+import hashlib
 import os
 import sys
 import traceback
@@ -15,25 +28,74 @@ except Exception as e:
     traceback.print_exc(file=sys.stderr)
     raise  # Vercel will capture this
 
-app = FastAPI(title="Docstring Generation Agent")
+# Body limits in bytes: the 100k-character source cap plus room for JSON
+# escaping and the other fields, per item for the batch endpoint.
+MAX_BODY_BYTES = 120_000
+BODY_LIMITS = {"/api/generate_batch": MAX_BODY_BYTES * MAX_BATCH_ITEMS}
+
+class BodySizeLimitMiddleware:
+    """Reject oversize requests by Content-Length before the body is read."""
+
+    def __init__(self, app, default_limit: int, limits: dict[str, int]):
+        self.app = app
+        self.default_limit = default_limit
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            limit = self.limits.get(scope["path"], self.default_limit)
+            for name, value in scope["headers"]:
+                if name == b"content-length" and value.isdigit() and int(value) > limit:
+                    response = ORJSONResponse(
+                        {"detail": "Payload too large. Please process smaller files."},
+                        status_code=413,
+                    )
+                    await response(scope, receive, send)
+                    return
+
+        await self.app(scope, receive, send)
+
+app = FastAPI(title="Docstring Generation Agent", default_response_class=ORJSONResponse)
+app.add_middleware(BodySizeLimitMiddleware, default_limit=MAX_BODY_BYTES, limits=BODY_LIMITS)
+
+def to_response(documented_code: str) -> CodeResponse:
+    if documented_code.startswith(PARTIAL_FAILURE_WARNING):
+        return CodeResponse(documented_code=documented_code, message="Docstrings generated for part of the file; some definitions failed.")
 
-@app.post("/api/generate", response_model=CodeResponse)
-async def generate(request: CodeRequest):
-    if len(request.source_code) > 100000: 
-        raise HTTPException(status_code=413, detail="Payload too large. Please process smaller files.")
-        
-    documented_code = generate_docstrings(request.source_code)
-    
     if "Error:" in documented_code:
         return CodeResponse(documented_code=documented_code, message="Failed or empty input.")
-        
+
     return CodeResponse(documented_code=documented_code, message="Docstrings generated successfully!")
 
+@app.post("/api/generate", response_model=CodeResponse)
+async def generate(request: CodeRequest):
+    documented_code = await agenerate_docstrings(request.source_code, request.priority)
+    return to_response(documented_code)
+
+@app.post("/api/generate_batch", response_model=CodeBatchResponse)
+async def generate_batch(request: CodeBatchRequest):
+    documented = await agenerate_docstrings_batch(
+        [item.source_code for item in request.items],
+        [item.priority for item in request.items],
+    )
+    return CodeBatchResponse(results=[to_response(code) for code in documented])
+
+@app.post("/api/generate_stream")
+async def generate_stream(request: CodeRequest):
+    return StreamingResponse(stream_docstrings(request.source_code), media_type="text/plain")
+
 base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 frontend_path = os.path.join(base_dir, "frontend")
 
 app.mount("/static", StaticFiles(directory=frontend_path), name="static")
 
+INDEX_BYTES = Path(frontend_path, "index.html").read_bytes()
+INDEX_ETAG = f'"{hashlib.md5(INDEX_BYTES).hexdigest()}"'
+INDEX_HEADERS = {"ETag": INDEX_ETAG, "Cache-Control": "public, max-age=60"}
+
 @app.get("/")
-async def serve_index():
-    return FileResponse(os.path.join(frontend_path, "index.html"))
+async def serve_index(request: Request):
+    if request.headers.get("if-none-match") == INDEX_ETAG:
+        return Response(status_code=304, headers=INDEX_HEADERS)
+
+    return Response(INDEX_BYTES, media_type="text/html", headers=INDEX_HEADERS)
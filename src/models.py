@@ -1,9 +1,21 @@
-from pydantic import BaseModel
+from typing import Literal
+
+from pydantic import BaseModel, Field
+
+MAX_SOURCE_LENGTH = 100_000
+MAX_BATCH_ITEMS = 20
 
 class CodeRequest(BaseModel):
-    source_code: str
+    source_code: str = Field(max_length=MAX_SOURCE_LENGTH)
     filename: str = "snippet.py"
+    priority: Literal["interactive", "batch"] = "interactive"
 
 class CodeResponse(BaseModel):
     documented_code: str
-    message: str
\ No newline at end of file
+    message: str
+
+class CodeBatchRequest(BaseModel):
+    items: list[CodeRequest] = Field(max_length=MAX_BATCH_ITEMS)
+
+class CodeBatchResponse(BaseModel):
+    results: list[CodeResponse]
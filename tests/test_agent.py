@@ -0,0 +1,224 @@
+import ast
+import asyncio
+
+import pytest
+
+from src import agent
+
+PROPERTY_CODE = '''class K:
+    @property
+    def v(self):
+        return self._v
+
+    @v.setter
+    def v(self, value):
+        self._v = value
+'''
+
+PROPERTY_OUTPUT = '''class K:
+    @property
+    def v(self):
+        """Get v."""
+        ...
+
+    @v.setter
+    def v(self, value):
+        """Set v."""
+        ...
+'''
+
+
+class FakeChunk:
+    def __init__(self, content, finish_reason=None):
+        self.content = content
+        self.response_metadata = {"finish_reason": finish_reason} if finish_reason else {}
+
+
+class FakeChain:
+    def __init__(self, text, size):
+        self.text = text
+        self.size = size
+
+    async def astream(self, inputs):
+        for i in range(0, len(self.text), self.size):
+            yield FakeChunk(self.text[i:i + self.size])
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(monkeypatch):
+    monkeypatch.setattr(agent, "SEMANTIC_CACHE_ENABLED", False)
+    agent._response_cache.clear()
+    yield
+    agent._response_cache.clear()
+
+
+def stream(code, model_text, size, monkeypatch):
+    monkeypatch.setattr(agent, "_get_chain", lambda budget: FakeChain(model_text, size))
+
+    async def collect():
+        return [text async for text in agent.stream_docstrings(code)]
+
+    return asyncio.run(collect())
+
+
+# --- fix_docstring_indentation ----------------------------------------
+
+def test_fix_docstring_indentation_indents_sections():
+    code = 'def f(x):\n    """Do it.\n\n    Args:\n    x: thing\n    Returns:\n    int: y\n    """\n'
+    assert agent.fix_docstring_indentation(code) == (
+        'def f(x):\n    """Do it.\n\n    Args:\n        x: thing\n    Returns:\n        int: y\n    """\n'
+    )
+
+
+def test_fix_docstring_indentation_leaves_summary_line_alone():
+    code = 'def f():\n    """Returns: the value.\n    more\n    """\n'
+    assert agent.fix_docstring_indentation(code) == code
+
+
+# --- _parse -----------------------------------------------------------
+
+@pytest.mark.parametrize(
+    "code", ["x=" + "+".join(["1"] * 49000), "-" * 99000 + "1", "a = 1\0"]
+)
+def test_parse_rejects_pathological_input(code):
+    assert agent._parse(code) is None
+    assert not agent.is_fully_documented(code)
+
+
+# --- _restore_bodies --------------------------------------------------
+
+def test_restore_bodies_tells_getter_and_setter_apart():
+    restored = ast.parse(agent._restore_bodies(PROPERTY_OUTPUT, PROPERTY_CODE))
+    getter, setter = restored.body[0].body
+    assert ast.unparse(getter.body[1]) == "return self._v"
+    assert ast.unparse(setter.body[1]) == "self._v = value"
+
+
+# --- _splice_docstrings / _merge_docstrings ---------------------------
+
+def test_merge_docstrings_keeps_getter_and_setter_docstrings():
+    merged = agent._merge_docstrings(PROPERTY_OUTPUT, PROPERTY_CODE)
+    getter, setter = ast.parse(merged).body[0].body
+    assert ast.get_docstring(getter) == "Get v."
+    assert ast.get_docstring(setter) == "Set v."
+    assert "return self._v" in merged and "self._v = value" in merged
+
+
+def test_merge_docstrings_refuses_one_line_body():
+    code = "async def g(x):  return x\n"
+    output = 'async def g(x):\n    """G."""\n    return x\n'
+    assert agent._merge_docstrings(output, code) is None
+
+
+def test_merge_docstrings_refuses_changed_signature():
+    code = "def g(x):\n    return x\n"
+    output = 'def g(x, y):\n    """G."""\n    return x\n'
+    assert agent._merge_docstrings(output, code) is None
+
+
+def test_merge_docstrings_skips_undocumented_scopes():
+    code = "def f():\n    return 1\n\ndef g():\n    return 2\n"
+    output = 'def f():\n    """F."""\n    return 1\n\ndef g():\n    return 2\n'
+    merged = agent._merge_docstrings(output, code)
+    assert merged == 'def f():\n    """F."""\n    return 1\n\ndef g():\n    return 2\n'
+
+
+def test_splice_docstrings_goes_above_leading_comments():
+    code = "def f():\n    # note\n    return 1\n"
+    docstrings = agent._collect_docstrings(
+        ast.parse('def f():\n    """F."""\n'), 'def f():\n    """F."""\n'
+    )
+    spliced = agent._splice_docstrings(code, ast.parse(code), docstrings)
+    assert spliced == 'def f():\n    """F."""\n    # note\n    return 1\n'
+
+
+def test_postprocess_output_falls_back_when_merge_fails():
+    code = "def f(x):\n    '''Doc.'''\n    y = x + 1\n    return y\n\n\ndef g(x):\n    return x\n"
+    prompt_code = agent._minify_for_prompt(code)
+    assert prompt_code != code
+    output = prompt_code.replace("def g(x):", 'def g(x, y):\n    """G."""', 1)
+    result = agent.postprocess_output(output, code, prompt_code)
+    assert '"""G."""' in result
+    assert "y = x + 1" in result
+
+
+# --- _minify_for_prompt -----------------------------------------------
+
+def test_minify_for_prompt_collapses_documented_functions():
+    code = 'def f(x):\n    """Doc."""\n    y = x + 1\n    return y\n\n\ndef g(x):\n    return x\n'
+    minified = agent._minify_for_prompt(code)
+    assert "y = x + 1" not in minified
+    assert "return x" in minified
+
+
+def test_minify_for_prompt_skips_undocumented_one_line_bodies():
+    code = 'def f(x):\n    """Doc."""\n    y = x + 1\n    return y\n\n\nasync def g(x):  return x\n'
+    assert agent._minify_for_prompt(code) == code
+
+
+def test_minify_for_prompt_skips_undefined_names():
+    code = 'def f(x):\n    """Doc."""\n    y = x + 1\n    return y\n\n\ndef g(x):\n    return z\n'
+    assert agent._minify_for_prompt(code) == code
+
+
+# --- _split_lines / _split_top_level ----------------------------------
+
+def test_split_lines_matches_ast_line_numbers():
+    assert agent._split_lines("a\nb\r\nc\rd") == ["a\n", "b\r\n", "c\r", "d"]
+    assert agent._split_lines("x = 1  # \x0c\ny = 2\n") == ["x = 1  # \x0c\n", "y = 2\n"]
+
+
+def test_split_top_level_adds_module_context():
+    code = (
+        "import os\nimport sys\n\nBASE = '/tmp'\n\n\n"
+        "def f0():\n    return os.path.join(BASE, helper())\n\n\n"
+        "def helper():\n    return 1\n"
+    )
+    chunks = agent._split_top_level(ast.parse(code), code)
+    assert [(start, end) for start, end, _ in chunks] == [(6, 8), (10, 12)]
+    assert chunks[0][2] == (
+        "import os\nBASE = ...\nhelper = ...\n\n\n"
+        "def f0():\n    return os.path.join(BASE, helper())\n"
+    )
+    assert chunks[1][2] == "def helper():\n    return 1\n"
+    assert not agent._may_reference_undefined_names(ast.parse(chunks[0][2]))
+
+
+def test_stitch_chunks_reports_failed_chunks():
+    code = "import os\n\n\ndef f():\n    return os.sep\n\n\ndef g():\n    return 2\n"
+    chunks = agent._split_top_level(ast.parse(code), code)
+    outputs = [
+        'import os\n\n\ndef f():\n    """F."""\n    return os.sep',
+        "# Error generating docstrings: boom",
+    ]
+    stitched, complete = agent._stitch_chunks(code, chunks, outputs)
+    assert not complete
+    assert stitched == (
+        f"{agent.PARTIAL_FAILURE_WARNING} 8\n"
+        'import os\n\n\ndef f():\n    """F."""\n    return os.sep\n\n\ndef g():\n    return 2'
+    )
+
+
+# --- stream_docstrings ------------------------------------------------
+
+@pytest.mark.parametrize("size", [1, 2, 3, 9, 100])
+def test_stream_strips_split_fences(size, monkeypatch):
+    model_text = '```python\ndef g(x):\n    """G."""\n    return x\n```'
+    chunks = stream("def g(x):\n    return x\n", model_text, size, monkeypatch)
+    assert "".join(chunks) == 'def g(x):\n    """G."""\n    return x\n'
+
+
+@pytest.mark.parametrize("size", [1, 4, 100])
+def test_stream_drops_syntax_todos_for_valid_code(size, monkeypatch):
+    model_text = (
+        '```python\ndef g(x):\n    # TODO: Fix syntax error\n    """G."""\n    return x\n```'
+    )
+    chunks = stream("def g(x):\n    return x\n", model_text, size, monkeypatch)
+    assert all(agent.SYNTAX_TODO not in chunk for chunk in chunks)
+    assert "".join(chunks) == 'def g(x):\n    """G."""\n    return x\n'
+
+
+def test_stream_keeps_syntax_todos_for_invalid_code(monkeypatch):
+    model_text = 'def g(x:\n    # TODO: Fix syntax error\n    return x\n'
+    chunks = stream("def g(x:\n    return x\n", model_text, 3, monkeypatch)
+    assert agent.SYNTAX_TODO in "".join(chunks)